@@ -2,12 +2,30 @@
 
 from fastapi import FastAPI, Depends, HTTPException
 from common.authorizer import Authorizer
-from auth.schema import RegisterDetails, LoginDetails
+from auth.schema import RegisterDetails, LoginDetails, RoleChange
 from auth.authenticator import Authentificator
 from auth.password import get_password_hash, verify_password
-from auth.config import public_key, private_key, expire, algorithm, db_url, nats_url
+from auth.cache import NegativeCache
+from auth.events import EventBuffer
+from auth.config import (
+    public_key,
+    private_key,
+    expire,
+    algorithm,
+    db_url,
+    nats_url,
+    missing_email_ttl,
+    missing_email_cache_size,
+    login_events_capacity,
+    login_events_batch_size,
+    login_events_flush_interval,
+    login_events_coalesce_window,
+    max_role_changes,
+)
 from auth import dbmodel
 from sqlmodel import select, col
+from sqlalchemy import Integer, String, bindparam, column, or_, update, values
+from sqlalchemy.dialects.postgresql import insert
 from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlalchemy.ext.asyncio.engine import create_async_engine
 import orjson
@@ -23,9 +41,28 @@ stream = JStream(name="auth", subjects=["accounts.*", "accounts-streams.*"])
 auhtentificator = Authentificator(key=private_key, algorithm=algorithm, expire=expire)
 authorizer = Authorizer(key=public_key, algorithm=algorithm)
 engine = create_async_engine(db_url, echo=True)
+missing_emails = NegativeCache(ttl=missing_email_ttl, maxsize=missing_email_cache_size)
+login_events = EventBuffer(
+    publish=lambda msg: broker.publish(
+        msg, "accounts.account-logined", stream=stream.name
+    ),
+    capacity=login_events_capacity,
+    batch_size=login_events_batch_size,
+    flush_interval=login_events_flush_interval,
+    coalesce_window=login_events_coalesce_window,
+)
+
+# Only the columns needed to issue a token. The statement is built once, so its
+# compiled form is cached by SQLAlchemy and asyncpg reuses the prepared statement.
+login_statement = select(
+    dbmodel.Account.public_id, dbmodel.Account.role, dbmodel.Account.password_hash
+).where(col(dbmodel.Account.email) == bindparam("email"))
+email_taken_statement = select(dbmodel.Account.id).where(
+    col(dbmodel.Account.email) == bindparam("email")
+)
 
 
-async def add_account(fullname: str, email: str, password: str, role: str) -> None:
+async def add_account(fullname: str, email: str, password: str, role: str) -> bool:
     """Utility function to add new account into database.
 
     Args:
@@ -33,23 +70,50 @@ async def add_account(fullname: str, email: str, password: str, role: str) -> No
         email: popug's email address. Also used as login
         password: popug's password
         role: popug's role
+
+    Returns:
+        True if account was created, False if email is already taken.
     """
-    async with AsyncSession(engine, expire_on_commit=False) as session:
-        new_account = dbmodel.Account(
+    # Password hashing is deliberately slow, so don't pay for it when the email
+    # is known to be taken. The INSERT below still resolves concurrent inserts.
+    if email not in missing_emails:
+        async with engine.connect() as conn:
+            if (
+                await conn.execute(email_taken_statement, {"email": email})
+            ).first() is not None:
+                return False
+
+    now = datetime.now()
+    statement = (
+        insert(dbmodel.Account)
+        .values(
             fullname=fullname,
             email=email,
             role=role,
             public_id=str(uuid.uuid4()),
             password_hash=get_password_hash(password),
+            created_at=now,
+            updated_at=now,
         )
-        session.add(new_account)
-        await session.commit()
-        msg = new_account.model_dump_json(
-            exclude={"password_hash", "created_at", "updated_at", "id"}
-        ).encode()
+        .on_conflict_do_nothing(index_elements=["email"])
+        .returning(
+            dbmodel.Account.public_id,
+            dbmodel.Account.fullname,
+            dbmodel.Account.email,
+            dbmodel.Account.role,
+        )
+    )
+    async with engine.begin() as conn:
+        new_account = (await conn.execute(statement)).first()
 
+    missing_emails.discard(email)
+    if new_account is None:
+        return False
+
+    msg = orjson.dumps(new_account._asdict())
     await broker.publish(msg, "accounts-streams.account-created", stream=stream.name)
     await broker.publish(msg, "accounts.account-created", stream=stream.name)
+    return True
 
 
 @asynccontextmanager
@@ -65,22 +129,16 @@ async def instantiate_db_and_broker(app: FastAPI):
     async with engine.begin() as conn:
         await conn.run_sync(dbmodel.SQLModel.metadata.create_all)
 
-    async with AsyncSession(engine, expire_on_commit=False) as session:
-        if (
-            await session.exec(
-                select(dbmodel.Account).where(
-                    col(dbmodel.Account.email) == "admin@popug.com"
-                )
-            )
-        ).first() is None:
-            await add_account(
-                fullname="root",
-                email="admin@popug.com",
-                password="password",
-                role="admin",
-            )
+    await add_account(
+        fullname="root",
+        email="admin@popug.com",
+        password="password",
+        role="admin",
+    )
+    login_events.start()
 
     yield
+    await login_events.stop()
     await broker.close()
 
 
@@ -100,22 +158,13 @@ async def register(register_details: RegisterDetails) -> str:
     Returns:
         Message that account was created.
     """
-    async with AsyncSession(engine, expire_on_commit=False) as session:
-        account_with_email = (
-            await session.exec(
-                select(dbmodel.Account).where(
-                    col(dbmodel.Account.email) == register_details.email
-                )
-            )
-        ).first()
-        if account_with_email is not None:
-            raise HTTPException(status_code=400, detail="Email is taken")
-    await add_account(
+    if not await add_account(
         fullname=register_details.fullname,
         email=register_details.email,
         password=register_details.password,
         role="user",
-    )
+    ):
+        raise HTTPException(status_code=400, detail="Email is taken")
     return "Account created"
 
 
@@ -132,14 +181,15 @@ async def login(login_details: LoginDetails) -> str:
     Returns:
         JWT token
     """
-    async with AsyncSession(engine, expire_on_commit=False) as session:
-        account_with_email = (
-            await session.exec(
-                select(dbmodel.Account).where(
-                    col(dbmodel.Account.email) == login_details.email
-                )
-            )
-        ).first()
+    account_with_email = None
+    if login_details.email not in missing_emails:
+        generation = missing_emails.generation
+        async with engine.connect() as conn:
+            account_with_email = (
+                await conn.execute(login_statement, {"email": login_details.email})
+            ).first()
+        if account_with_email is None:
+            missing_emails.add(login_details.email, generation)
 
     if (account_with_email is None) or (
         not verify_password(login_details.password, account_with_email.password_hash)
@@ -148,16 +198,15 @@ async def login(login_details: LoginDetails) -> str:
     token = auhtentificator.encode_token(
         account_with_email.public_id, account_with_email.role
     )
-    await broker.publish(
+    login_events.put(
         orjson.dumps(
             dict(
                 public_id=account_with_email.public_id,
-                email=account_with_email.email,
+                email=login_details.email,
                 logined_at=datetime.now(),
             )
         ),
-        "accounts.account-logined",
-        stream=stream.name,
+        key=account_with_email.public_id,
     )
 
     return token
@@ -191,16 +240,22 @@ async def change_role(
             status_code=400, detail="Provide either public_user_id or email"
         )
 
+    if email is not None and email in missing_emails:
+        raise HTTPException(status_code=404, detail="Account not found")
+
     statement = (
         select(dbmodel.Account).where(col(dbmodel.Account.public_id) == public_user_id)
         if public_user_id is not None
         else select(dbmodel.Account).where(col(dbmodel.Account.email) == email)
     )
 
+    generation = missing_emails.generation
     async with AsyncSession(engine, expire_on_commit=False) as session:
         account = (await session.exec(statement)).first()
         print(account)
         if account is None:
+            if email is not None:
+                missing_emails.add(email, generation)
             raise HTTPException(status_code=404, detail="Account not found")
         account.role = role
         account.updated_at = datetime.now()
@@ -213,3 +268,85 @@ async def change_role(
         ).encode()
     await broker.publish(msg, "accounts-streams.role-changed", stream=stream.name)
     return f"Role for {account.email} changed to {account.role}"
+
+
+@api.post(
+    "/change-roles",
+    status_code=200,
+    dependencies=[Depends(authorizer.restrict_access(to=["admin", "manager"]))],
+)
+async def change_roles(changes: list[RoleChange]) -> dict:
+    """Changes roles of many popugs in a single UPDATE.
+
+    Args:
+        changes: list of new roles, each for either public_id or email of popug.
+            If the same popug is listed several times, the last role wins.
+
+    Raises:
+        HTTPException: if more than `max_role_changes` changes are requested
+
+    Returns:
+        Json of changed accounts and of changes whose account was not found.
+    """
+    if len(changes) > max_role_changes:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {max_role_changes} role changes per request",
+        )
+    if len(changes) == 0:
+        return dict(changed=[], not_found=[])
+
+    requested = values(
+        column("position", Integer),
+        column("public_id", String),
+        column("email", String),
+        column("role", String),
+        name="requested",
+    ).data([(i, c.public_id, c.email, c.role) for i, c in enumerate(changes)])
+    # A popug may be listed both by public_id and by email, so the latest
+    # requested role is resolved per account before updating.
+    resolved = (
+        select(col(dbmodel.Account.id).label("id"), requested.c.role)
+        .join(
+            requested,
+            or_(
+                col(dbmodel.Account.public_id) == requested.c.public_id,
+                col(dbmodel.Account.email) == requested.c.email,
+            ),
+        )
+        .distinct(col(dbmodel.Account.id))
+        .order_by(col(dbmodel.Account.id), requested.c.position.desc())
+        .subquery("resolved")
+    )
+    statement = (
+        update(dbmodel.Account)
+        .where(col(dbmodel.Account.id) == resolved.c.id)
+        .values(role=resolved.c.role, updated_at=datetime.now())
+        .returning(
+            dbmodel.Account.public_id,
+            dbmodel.Account.fullname,
+            dbmodel.Account.email,
+            dbmodel.Account.role,
+        )
+    )
+    generation = missing_emails.generation
+    async with engine.begin() as conn:
+        changed = [row._asdict() for row in (await conn.execute(statement)).all()]
+
+    found_ids = {account["public_id"] for account in changed}
+    found_emails = {account["email"] for account in changed}
+    not_found = [
+        change.model_dump(exclude_none=True)
+        for change in changes
+        if change.public_id not in found_ids and change.email not in found_emails
+    ]
+    for change in not_found:
+        if "email" in change:
+            missing_emails.add(change["email"], generation)
+    if len(changed) > 0:
+        await broker.publish(
+            orjson.dumps(changed),
+            "accounts-streams.role-changed",
+            stream=stream.name,
+        )
+    return dict(changed=changed, not_found=not_found)
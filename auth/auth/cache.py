@@ -0,0 +1,65 @@
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Optional
+
+
+class NegativeCache:
+    """Small in-process cache of keys that are known to be absent in database.
+
+    Entries expire after `ttl` and the oldest ones are evicted once `maxsize`
+    is reached, so the cache never grows unbounded under a flood of misses.
+
+    Args:
+        ttl: how long a key is considered absent
+        maxsize: maximum number of cached keys
+    """
+
+    def __init__(self, ttl: timedelta, maxsize: int) -> None:
+        self.ttl = ttl.total_seconds()
+        self.maxsize = maxsize
+        self.generation = 0
+        self._entries: OrderedDict[str, float] = OrderedDict()
+
+    def __contains__(self, key: str) -> bool:
+        """Checks whether key is cached as absent and not yet expired.
+
+        Args:
+            key: key to check, e.g. email
+
+        Returns:
+            True if key is known to be absent in database.
+        """
+        expires_at = self._entries.get(key)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return False
+        return True
+
+    def add(self, key: str, generation: Optional[int] = None) -> None:
+        """Records key as absent in database.
+
+        Args:
+            key: key that was not found, e.g. email
+            generation: value of `generation` read before the database lookup.
+                If any key was discarded since then, the lookup may have raced
+                with an insert, so the miss is not recorded. If None, the key
+                is recorded unconditionally.
+        """
+        if generation is not None and generation != self.generation:
+            return
+        self._entries[key] = time.monotonic() + self.ttl
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def discard(self, key: str) -> None:
+        """Forgets key after it was inserted into database and bumps `generation`.
+
+        Args:
+            key: inserted key, e.g. email
+        """
+        self.generation += 1
+        self._entries.pop(key, None)
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class EventBuffer:
+    """Bounded in-process buffer that publishes events in batches.
+
+    Events are enqueued without blocking and flushed by a background task
+    either when `batch_size` events are pending or every `flush_interval`.
+    At most `batch_size` events are published concurrently.
+    If `coalesce_window` is set, keyed events are held for that window and
+    only the latest event per key within it is published.
+    """
+
+    def __init__(
+        self,
+        publish: Callable[[bytes], Awaitable[None]],
+        capacity: int,
+        batch_size: int,
+        flush_interval: timedelta,
+        coalesce_window: Optional[timedelta] = None,
+    ) -> None:
+        self.publish = publish
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval.total_seconds()
+        self.coalesce_window = (
+            coalesce_window.total_seconds() if coalesce_window is not None else None
+        )
+        self.dropped = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.failed = 0
+        self._pending: list[bytes] = []
+        self._coalescing: dict[str, tuple[float, bytes]] = {}
+        self._wakeup = asyncio.Event()
+        self._reported_dropped = 0
+        self._closing = False
+        self._task: Optional[asyncio.Task] = None
+
+    def put(self, msg: bytes, key: Optional[str] = None) -> bool:
+        """Enqueues event without waiting for it to be published.
+
+        Args:
+            msg: encoded event
+            key: key used for coalescing, e.g. popug's public_id
+
+        Returns:
+            True if event was enqueued or replaced a pending event with the same
+            key, False if it was dropped.
+        """
+        coalesce = key is not None and self.coalesce_window is not None
+        if coalesce and key in self._coalescing and not self._closing:
+            first_seen, _ = self._coalescing[key]
+            self._coalescing[key] = (first_seen, msg)
+            self.coalesced += 1
+            return True
+        if self._closing or len(self) >= self.capacity:
+            self.dropped += 1
+            return False
+        if coalesce:
+            self._coalescing[key] = (time.monotonic(), msg)
+        else:
+            self._pending.append(msg)
+        if len(self) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def __len__(self) -> int:
+        """Returns the number of events waiting to be published."""
+        return len(self._pending) + len(self._coalescing)
+
+    async def flush(self) -> None:
+        """Publishes pending events, at most `batch_size` of them concurrently."""
+        self._wakeup.clear()
+        batch, self._pending = self._pending, []
+        if self.dropped > self._reported_dropped:
+            logger.warning(
+                "Event buffer is full, dropped %d events since last flush",
+                self.dropped - self._reported_dropped,
+            )
+            self._reported_dropped = self.dropped
+        if self.coalesce_window is not None:
+            expired = time.monotonic() - self.coalesce_window
+            for key, (first_seen, msg) in list(self._coalescing.items()):
+                if self._closing or first_seen <= expired:
+                    batch.append(msg)
+                    del self._coalescing[key]
+        for start in range(0, len(batch), self.batch_size):
+            chunk = batch[start : start + self.batch_size]
+            results = await asyncio.gather(
+                *(self.publish(msg) for msg in chunk), return_exceptions=True
+            )
+            errors = [
+                result for result in results if isinstance(result, BaseException)
+            ]
+            self.failed += len(errors)
+            self.flushed += len(chunk) - len(errors)
+            if len(errors) > 0:
+                logger.warning(
+                    "Failed to publish %d of %d events: %r",
+                    len(errors),
+                    len(chunk),
+                    errors[0],
+                )
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def start(self) -> None:
+        """Starts background flushing task."""
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops accepting events and drains whatever is still pending."""
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+        logger.info(
+            "Event buffer stopped: flushed=%d failed=%d dropped=%d coalesced=%d",
+            self.flushed,
+            self.failed,
+            self.dropped,
+            self.coalesced,
+        )
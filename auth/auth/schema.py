@@ -1,4 +1,5 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, model_validator
+from typing import Optional
 
 
 class RegisterDetails(BaseModel):
@@ -10,3 +11,15 @@ class RegisterDetails(BaseModel):
 class LoginDetails(BaseModel):
     email: EmailStr
     password: str
+
+
+class RoleChange(BaseModel):
+    role: str
+    public_id: Optional[str] = None
+    email: Optional[EmailStr] = None
+
+    @model_validator(mode="after")
+    def check_single_identifier(self) -> "RoleChange":
+        if (self.public_id is None) + (self.email is None) != 1:
+            raise ValueError("Provide either public_id or email")
+        return self
@@ -10,6 +10,7 @@ from tasktracker.config import (
 )
 from tasktracker import dbmodel
 from sqlmodel import select, col
+from sqlalchemy.dialects.postgresql import insert
 from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlalchemy.ext.asyncio.engine import create_async_engine
 from contextlib import asynccontextmanager
@@ -17,7 +18,7 @@ import uuid
 from datetime import datetime
 from faststream.nats import NatsBroker, JStream
 import numpy as np
-from typing import Literal, Optional
+from typing import Literal, Optional, Union
 
 broker = NatsBroker(nats_url)
 stream = JStream(name="tasks", subjects=["tasks.*", "tasks-streams.*"])
@@ -71,40 +72,51 @@ async def handle_new_account(public_id: str, fullname: str, email: str, role: st
         await session.commit()
 
 
+async def upsert_accounts(accounts: list[dict[str, str]]) -> None:
+    """Utility function to apply account changes in a single statement.
+
+    Roles of known accounts are updated, unknown accounts are created.
+
+    Args:
+        accounts: list of accounts with public_id, fullname, email and role
+    """
+    statement = insert(dbmodel.Account).values(
+        [
+            dict(
+                public_id=account["public_id"],
+                fullname=account["fullname"],
+                email=account["email"],
+                role=account["role"],
+            )
+            for account in accounts
+        ]
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=["public_id"], set_=dict(role=statement.excluded.role)
+    )
+    async with engine.begin() as conn:
+        await conn.execute(statement)
+
+
 @broker.subscriber(
     "accounts-streams.role-changed",
     stream=JStream(name="auth", declare=False),
     deliver_policy="all",
 )
-async def role_changed(public_id: str, fullname: str, email: str, role: str):
-    """Handles CUD event of account's role change.
+async def role_changed(accounts: Union[dict[str, str], list[dict[str, str]]]):
+    """Handles CUD event of role change of one account or of a batch of accounts.
+
+    Both kinds share one subject, so they are applied in the order they were
+    published, also when the stream is replayed.
 
     Args:
-        public_id: uuid of account
-        fullname: fullname
-        email: email
-        role: new role
+        accounts: account or list of accounts with public_id, fullname, email
+            and new role
     """
-    async with AsyncSession(engine, expire_on_commit=False) as session:
-        account = (
-            await session.exec(
-                select(dbmodel.Account).where(
-                    col(dbmodel.Account.public_id) == public_id
-                )
-            )
-        ).first()
-        if account is not None:
-            account.role = role
-            session.add(account)
-            await session.commit()
-            await session.refresh(account)
-        else:
-            session.add(
-                dbmodel.Account(
-                    public_id=public_id, fullname=fullname, email=email, role=role
-                )
-            )
-            await session.commit()
+    if isinstance(accounts, dict):
+        accounts = [accounts]
+    if len(accounts) > 0:
+        await upsert_accounts(accounts)
 
 
 @asynccontextmanager